@@ -1,46 +1,304 @@
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Depends, Query, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, or_
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from cachetools import LRUCache, TTLCache
+from sqlalchemy import Row, event, text, select, insert, update, func, bindparam, Column, Integer, String, Text, LargeBinary, DateTime, Index, or_
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-import json
+import asyncio
+import secrets
+import msgspec
+import orjson
 
 # ------------------ 数据库配置 ------------------
-DATABASE_URL = "sqlite:///./db.sqlite3"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(bind=engine)
+DATABASE_URL = "sqlite+aiosqlite:///./db.sqlite3"
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=20,
+    max_overflow=10,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+)
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL 模式下读写互不阻塞，synchronous=NORMAL 减少每次提交的 fsync
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 Base = declarative_base()
 
 
+class EnrollmentData(msgspec.Struct):
+    """Task.data 中存储的报名信息（即 EnrollRequest 的内容）"""
+    school_id: str
+    student: Dict[str, Any]
+    preferences: Dict[str, Any]
+    consent_timestamp: str
+
+
+# Task.data 使用 msgpack 编码存储
+encoder = msgspec.msgpack.Encoder()
+decoder = msgspec.msgpack.Decoder(EnrollmentData)
+
+
 class Task(Base):
     __tablename__ = "tasks"
     id = Column(Integer, primary_key=True, index=True)
-    school_id = Column(String, index=True)
-    data = Column(Text)  # JSON
+    school_id = Column(String)
+    data = Column(LargeBinary)  # msgpack
     created_at = Column(DateTime, default=datetime.utcnow)
     # 新增字段用于任务状态跟踪
-    status = Column(String, default="pending")  # pending, processing, completed, failed
+    status = Column(String, default="pending", index=True)  # pending, processing, completed, failed
     updated_at = Column(DateTime, default=datetime.utcnow)
     progress = Column(Integer, default=10)  # 0-100
     message = Column(String, default="任务已创建，等待处理")
+    # 从 student 中冗余出来用于索引查询
+    email = Column(String, index=True)
+    phone = Column(String, index=True)
+
+
+# 覆盖 /api/tasks 的 school_id 等值 + created_at 范围查询
+Index("ix_tasks_school_created", Task.school_id, Task.created_at)
+
+
+def contact_field(student: Dict[str, Any], key: str) -> Optional[str]:
+    """student 是任意 JSON，只有字符串值才写入 email / phone 索引列"""
+    value = student.get(key)
+    return value if isinstance(value, str) else None
 
 
 class Config(Base):
     __tablename__ = "configs"
     id = Column(Integer, primary_key=True, index=True)
-    school_id = Column(String, nullable=True)  # NULL 表示全局
+    school_id = Column(String, nullable=True, index=True)  # NULL 表示全局
     data = Column(Text)  # JSON
     updated_at = Column(DateTime, default=datetime.utcnow)
 
 
-# 创建所有表
-Base.metadata.create_all(bind=engine)
+class QuarantinedTask(Base):
+    """无法写入或无法解析的报名数据原样保存在这里，对应任务标记为 failed"""
+    __tablename__ = "tasks_quarantine"
+    task_id = Column(Integer, primary_key=True)
+    data = Column(LargeBinary)
+    reason = Column(String)
+    quarantined_at = Column(DateTime, default=datetime.utcnow)
+
+
+# 时间在 SQL 中直接格式化为 ISO 8601 字符串（UTC），省去 Python 端的解析和格式化；
+# 存储格式为 "YYYY-MM-DD HH:MM:SS.ffffff"，截断到毫秒而不是用 strftime 的 %f 四舍五入，
+# 这样返回的 created_at 不会晚于实际值，可以直接作为 since 游标
+def iso_timestamp(column):
+    return func.replace(func.substr(column, 1, 23), " ", "T", type_=String) + "Z"
+
+
+# 列表接口只取需要的列，返回元组行，不构建 ORM 对象
+_TASK_COLUMNS = (
+    Task.id,
+    Task.status,
+    Task.progress,
+    Task.message,
+    iso_timestamp(Task.created_at).label("created_at"),
+    iso_timestamp(Task.updated_at).label("updated_at"),
+    Task.data
+)
+
+# 热点查询在模块加载时构建一次，请求中只传入绑定参数
+# 两种情况都按创建时间正序返回，since 作为向后翻页的游标
+_TASKS_BY_SCHOOL = (
+    select(*_TASK_COLUMNS)
+    .where(Task.school_id == bindparam("school_id"))
+    .order_by(Task.created_at)
+    .limit(bindparam("limit"))
+)
+_TASKS_BY_SCHOOL_SINCE = (
+    select(*_TASK_COLUMNS)
+    .where(
+        Task.school_id == bindparam("school_id"),
+        # since 沿用 created_at 的 DateTime 类型绑定，写成与存储一致的格式再比较
+        Task.created_at >= bindparam("since")
+    )
+    .order_by(Task.created_at)
+    .limit(bindparam("limit"))
+)
+_TASK_BY_ID = select(*_TASK_COLUMNS, Task.school_id).where(Task.id == bindparam("task_id"))
+# 一次查询同时取驾校配置和全局配置，驾校配置排在前面
+_CONFIG_FOR_SCHOOL = (
+    select(Config)
+    .where(or_(Config.school_id == bindparam("school_id"), Config.school_id.is_(None)))
+    .order_by(Config.school_id.is_(None))
+    .limit(1)
+)
+_STATUS_COUNTS = select(Task.status, func.count()).group_by(Task.status)
+
+
+def check_schema(conn):
+    """create_all 不会升级已存在的表，旧版本创建的数据库需要先运行 python migrate.py"""
+    for table in Base.metadata.sorted_tables:
+        columns = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table.name})"))}
+        indexes = {row[1] for row in conn.execute(text(f"PRAGMA index_list({table.name})"))}
+        missing = [column.name for column in table.columns if column.name not in columns]
+        missing += [index.name for index in table.indexes if index.name not in indexes]
+        if missing:
+            raise RuntimeError(
+                f"表 {table.name} 缺少 {', '.join(missing)}，请先运行 python migrate.py 升级数据库"
+            )
+    # 读取路径假定 Task.data 全部是 msgpack，不再逐行容错
+    if conn.execute(text("SELECT 1 FROM tasks WHERE typeof(data) != 'blob' LIMIT 1")).first():
+        raise RuntimeError("tasks 表中仍有旧格式数据，请先运行 python migrate.py 升级数据库")
+
+
+async def get_db():
+    """每个请求从连接池获取一个会话，请求结束（包括异常）时归还"""
+    async with SessionLocal() as db:
+        yield db
+
+
+# ------------------ 后台写入 ------------------
+ENROLL_BATCH_SIZE = 50
+# 队列满时 enroll 会等待，给写入方施加背压
+ENROLL_QUEUE_SIZE = 1000
+
+
+# 数据库被锁时的最长重试间隔（秒）
+ENROLL_RETRY_MAX_DELAY = 5
+
+# 已确认但还在队列中的报名：task_id -> 写库（或隔离）完成时 set 的 Event
+pending_tasks: Dict[int, asyncio.Event] = {}
+
+
+async def wait_until_written(task_id: int):
+    """task_id 还在写入队列中时，等它落库后再查询或更新"""
+    written = pending_tasks.get(task_id)
+    if written is not None:
+        await written.wait()
+
+
+async def retry_when_busy(write, *args):
+    """多 worker 争抢写锁时会出现 OperationalError（database is locked），
+    已确认的报名不能因此丢失，退避后重试直到成功"""
+    delay = 0.1
+    while True:
+        try:
+            return await write(*args)
+        except OperationalError as e:
+            print(f"Database busy, retrying in {delay:.1f}s: {e.orig}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, ENROLL_RETRY_MAX_DELAY)
+
+
+async def insert_tasks(rows: List[Dict[str, Any]]):
+    async with SessionLocal() as db:
+        await db.execute(insert(Task), rows)
+        await db.commit()
+
+
+async def quarantine_enrollment(row: Dict[str, Any], reason: str):
+    """写不进去的报名记录保存到 tasks_quarantine，并留下一条 failed 任务供客户端查询"""
+    async with SessionLocal() as db:
+        await db.execute(
+            insert(QuarantinedTask).prefix_with("OR REPLACE"),
+            {"task_id": row["id"], "data": row["data"], "reason": reason, "quarantined_at": datetime.utcnow()}
+        )
+        await db.commit()
+        try:
+            await db.execute(insert(Task), [{
+                **row,
+                "email": None,
+                "phone": None,
+                "status": "failed",
+                "message": "报名数据写入失败，已隔离"
+            }])
+            await db.commit()
+        except IntegrityError:
+            # task_id 与已有任务冲突，不覆盖已有任务
+            await db.rollback()
+    print(f"Quarantined enrollment {row['id']}: {reason}")
+
+
+async def write_enrollments(rows: List[Dict[str, Any]]):
+    """在一个事务中批量插入报名记录"""
+    try:
+        await retry_when_busy(insert_tasks, rows)
+        return
+    except Exception as e:
+        print(f"Error writing enrollments: {e}")
+    # 整批因数据问题失败时逐条写入，避免一条坏数据拖累同批的其他记录
+    for row in rows:
+        try:
+            await retry_when_busy(insert_tasks, [row])
+        except Exception as e:
+            await retry_when_busy(quarantine_enrollment, row, repr(e))
+
+
+async def enroll_writer(queue: asyncio.Queue):
+    """从队列中取出报名记录批量写库，收到 None 时写完剩余数据后退出"""
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < ENROLL_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+        rows = [row for row in batch if row is not None]
+        if rows:
+            try:
+                await write_enrollments(rows)
+            finally:
+                for row in rows:
+                    written = pending_tasks.pop(row["id"], None)
+                    if written is not None:
+                        written.set()
+        if len(rows) < len(batch):
+            return
+
+
+def start_enroll_writer(state):
+    state.enroll_writer = asyncio.create_task(enroll_writer(state.enroll_queue))
+    state.enroll_writer.add_done_callback(lambda writer: on_writer_done(state, writer))
+
+
+def on_writer_done(state, writer: asyncio.Task):
+    """写入任务异常退出时记录原因并重启，队列中剩余的报名由新任务继续写入"""
+    if not writer.cancelled() and writer.exception() is not None:
+        print(f"Enroll writer stopped, restarting: {writer.exception()!r}")
+        start_enroll_writer(state)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 创建所有表；数据升级由 migrate.py 一次性完成，这里只做检查，
+    # 避免多个 worker 同时启动时争抢写锁
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(check_schema)
+
+    app.state.enroll_queue = asyncio.Queue(maxsize=ENROLL_QUEUE_SIZE)
+    start_enroll_writer(app.state)
+    yield
+    if not app.state.enroll_writer.done():
+        await app.state.enroll_queue.put(None)
+        await app.state.enroll_writer
+    await engine.dispose()
+
 
 # ------------------ FastAPI ------------------
-app = FastAPI(title="ICBC Central API", version="0.1")
+app = FastAPI(
+    title="ICBC Central API",
+    version="0.1",
+    lifespan=lifespan
+)
 
 # 添加 CORS 中间件
 app.add_middleware(
@@ -87,276 +345,369 @@ class TaskUpdateRequest(BaseModel):
     message: Optional[str] = None
 
 
+class ReportResponse(BaseModel):
+    status: str
+    received: ReportRequest
+
+
+class TaskStatusResponse(BaseModel):
+    task_id: int
+    status: str
+    progress: int
+    message: Optional[str]
+    created_at: str
+    updated_at: str
+    school_id: Optional[str]
+    student_info: Dict[str, Any]
+    preferences: Dict[str, Any]
+
+
+# 列表接口的输出直接由 msgspec 编码，不再逐行拼装 dict
+class TaskOut(msgspec.Struct):
+    task_id: int
+    status: str
+    progress: int
+    message: Optional[str]
+    created_at: str
+    updated_at: str
+    school_id: str
+    student: Dict[str, Any]
+    preferences: Dict[str, Any]
+    consent_timestamp: str
+
+
+class EnrollmentOut(TaskOut):
+    enrollment_id: int
+
+
+json_encoder = msgspec.json.Encoder()
+
+
+def to_task_out(task: Row) -> TaskOut:
+    data = decoder.decode(task.data)
+    return TaskOut(
+        task_id=task.id,
+        status=task.status,
+        progress=task.progress,
+        message=task.message,
+        created_at=task.created_at,
+        updated_at=task.updated_at,
+        school_id=data.school_id,
+        student=data.student,
+        preferences=data.preferences,
+        consent_timestamp=data.consent_timestamp
+    )
+
+
+def to_enrollment_out(task: Row) -> EnrollmentOut:
+    data = decoder.decode(task.data)
+    return EnrollmentOut(
+        task_id=task.id,
+        status=task.status,
+        progress=task.progress,
+        message=task.message,
+        created_at=task.created_at,
+        updated_at=task.updated_at,
+        school_id=data.school_id,
+        student=data.student,
+        preferences=data.preferences,
+        consent_timestamp=data.consent_timestamp,
+        enrollment_id=task.id
+    )
+
+
 # ------------------ 原有路由 ------------------
 @app.get("/healthz")
-def health_check():
+async def health_check(request: Request):
+    if request.app.state.enroll_writer.done():
+        raise HTTPException(status_code=503, detail="报名写入服务不可用")
     return {"status": "ok"}
 
 
 @app.post("/api/enroll")
-def enroll(req: EnrollRequest):
-    try:
-        db = SessionLocal()
-        task = Task(
-            school_id=req.school_id,
-            data=json.dumps(req.dict()),
-            status="pending",
-            progress=10,
-            message="报名信息已接收，等待处理"
-        )
-        db.add(task)
-        db.commit()
-        db.refresh(task)
-        db.close()
-        return {
-            "status": "ok", 
-            "task_id": task.id,
-            "message": "报名成功，您可以使用task_id查询处理进度"
-        }
-    except Exception as e:
-        print(f"Error in enroll: {e}")
-        return {"status": "error", "message": str(e)}
+async def enroll(req: EnrollRequest, request: Request):
+    # 后台写入任务异常退出后不再接收报名，避免返回永远不会落库的 task_id
+    if request.app.state.enroll_writer.done():
+        return {"status": "error", "message": "报名写入服务不可用，请稍后重试"}
+    # task_id 在这里直接生成，写库交给后台批量完成；
+    # 取 53 位以内的随机整数，多进程部署也不会冲突，且 JS 客户端可以精确表示
+    task_id = secrets.randbits(53)
+    now = datetime.utcnow()
+    await request.app.state.enroll_queue.put({
+        "id": task_id,
+        "school_id": req.school_id,
+        "data": encoder.encode(req.model_dump()),
+        "email": contact_field(req.student, "email"),
+        "phone": contact_field(req.student, "phone"),
+        "status": "pending",
+        "progress": 10,
+        "message": "报名信息已接收，等待处理",
+        "created_at": now,
+        "updated_at": now
+    })
+    # put 放入记录后不会再让出事件循环，写入任务一定在登记之后才取到这条记录
+    pending_tasks[task_id] = asyncio.Event()
+    return {
+        "status": "ok", 
+        "task_id": task_id,
+        "message": "报名成功，您可以使用task_id查询处理进度"
+    }
 
 
 @app.get("/api/tasks")
-def get_tasks(school_id: str, since: Optional[str] = None):
-    db = SessionLocal()
-    q = db.query(Task).filter(Task.school_id == school_id)
+async def get_tasks(
+    school_id: str,
+    since: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    """按创建时间正序返回驾校的任务；has_more 为 true 时，
+    以本页最后一条的 created_at 作为 since 继续查询（该条会再次返回）"""
+    # 多取一行用于判断是否还有更多数据
+    params = {"school_id": school_id, "limit": limit + 1}
     if since:
-        q = q.filter(Task.created_at >= since)
-    tasks = q.all()
-    db.close()
-    return {
-        "tasks": [
-            {
-                "task_id": t.id, 
-                "status": t.status,
-                "progress": t.progress,
-                "message": t.message,
-                "created_at": t.created_at.isoformat(),
-                "updated_at": t.updated_at.isoformat(),
-                **json.loads(t.data)
-            } for t in tasks
-        ]
-    }
+        # 存储的时间是不带时区的 UTC
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        result = await db.execute(_TASKS_BY_SCHOOL_SINCE, {**params, "since": since})
+    else:
+        result = await db.execute(_TASKS_BY_SCHOOL, params)
+    tasks = result.all()
+    return Response(
+        content=json_encoder.encode({
+            "tasks": [to_task_out(t) for t in tasks[:limit]],
+            "has_more": len(tasks) > limit
+        }),
+        media_type="application/json"
+    )
+
+
+# 客户端会反复轮询 /api/tasks/{task_id}，按 task_id 缓存查询结果，任务被修改时失效；
+# 多 worker 部署时其他进程的缓存无法被通知，TTL 限制其最长过期时间
+task_cache = TTLCache(maxsize=10_000, ttl=10)
+# 每个任务的修改计数；查询期间任务被修改时，查到的结果已经过期，不能写入缓存
+task_versions = LRUCache(maxsize=100_000)
+
+
+def invalidate_task(task_id: int):
+    task_cache.pop(task_id, None)
+    task_versions[task_id] = task_versions.get(task_id, 0) + 1
 
 
 @app.post("/api/report")
-def report(req: ReportRequest):
+async def report(req: ReportRequest, db: AsyncSession = Depends(get_db)) -> ReportResponse:
     # 这里可以加：存数据库 / 发通知
     # 当有报名位置时，更新相关任务状态
+    await wait_until_written(req.task_id)
     try:
-        db = SessionLocal()
-        # 更新对应任务的状态
-        task = db.query(Task).filter(Task.id == req.task_id).first()
-        if task:
-            task.status = "completed"
-            task.progress = 100
-            task.message = f"找到 {len(req.slots_found)} 个可用时间段"
-            task.updated_at = datetime.utcnow()
-            db.commit()
-        db.close()
+        # 更新对应任务的状态，一条 UPDATE 同时完成存在性检查
+        stmt = (
+            update(Task)
+            .where(Task.id == req.task_id)
+            .values(
+                status="completed",
+                progress=100,
+                message=f"找到 {len(req.slots_found)} 个可用时间段",
+                updated_at=datetime.utcnow()
+            )
+            .execution_options(synchronize_session=False)
+        )
+        result = await db.execute(stmt)
+        await db.commit()
+        invalidate_task(req.task_id)
+        if result.rowcount == 0:
+            print(f"Report for unknown task: {req.task_id}")
     except Exception as e:
         print(f"Error updating task status: {e}")
     
-    return {"status": "ok", "received": req.dict()}
+    return ReportResponse(status="ok", received=req)
+
+
+# 默认参数，启动时预先序列化
+DEFAULT_CONFIG = {
+    "rate_limits": {
+        "per_task_interval_min": 15,
+        "jitter_percent": 30,
+        "max_checks_per_hour": 20,
+        "max_checks_per_day": 200,
+        "backoff_enabled": True,
+        "backoff_factor": 2,
+        "max_interval_min": 60
+    },
+    "notifications": {
+        "allow_email": True,
+        "allow_sms": True,
+        "allow_telegram": True
+    },
+    "agent": {
+        "heartbeat_interval_min": 10,
+        "update_required": False,
+        "latest_version": "1.0.0"
+    }
+}
+DEFAULT_CONFIG_BYTES = orjson.dumps(DEFAULT_CONFIG)
+
+# agent 每次心跳都会拉取配置，按 school_id 缓存 30 秒（缓存序列化后的 bytes）
+config_cache = TTLCache(maxsize=1024, ttl=30)
 
 
 @app.get("/api/config")
-def get_config(school_id: str):
-    db = SessionLocal()
-    # 优先取该驾校配置
-    cfg = db.query(Config).filter(Config.school_id == school_id).first()
-    if not cfg:
-        cfg = db.query(Config).filter(Config.school_id == None).first()
+async def get_config(school_id: str, db: AsyncSession = Depends(get_db)):
+    content = config_cache.get(school_id)
+    if content is None:
+        content = await load_config(db, school_id)
+        config_cache[school_id] = content
+    return Response(content=content, media_type="application/json")
+
+
+async def load_config(db: AsyncSession, school_id: str) -> bytes:
+    # 优先取该驾校配置，没有则取全局配置
+    cfg = await db.scalar(_CONFIG_FOR_SCHOOL, {"school_id": school_id})
 
     if cfg:
-        db.close()
-        return json.loads(cfg.data)
+        # 存储的就是 JSON 文本，原样返回
+        return cfg.data.encode()
     else:
-        db.close()
-        # 默认参数
-        return {
-            "rate_limits": {
-                "per_task_interval_min": 15,
-                "jitter_percent": 30,
-                "max_checks_per_hour": 20,
-                "max_checks_per_day": 200,
-                "backoff_enabled": True,
-                "backoff_factor": 2,
-                "max_interval_min": 60
-            },
-            "notifications": {
-                "allow_email": True,
-                "allow_sms": True,
-                "allow_telegram": True
-            },
-            "agent": {
-                "heartbeat_interval_min": 10,
-                "update_required": False,
-                "latest_version": "1.0.0"
-            }
-        }
+        return DEFAULT_CONFIG_BYTES
 
 
 # ------------------ 新增的监控和查询路由 ------------------
 
 @app.get("/api/tasks/{task_id}")
-def get_task_status(task_id: int):
+async def get_task_status(task_id: int, db: AsyncSession = Depends(get_db)) -> TaskStatusResponse:
     """查询特定任务的状态"""
-    db = SessionLocal()
-    try:
-        task = db.query(Task).filter(Task.id == task_id).first()
-        if not task:
-            raise HTTPException(status_code=404, detail="Task not found")
-        
-        # 解析原始数据
-        task_data = json.loads(task.data)
-        
-        result = {
-            "task_id": task.id,
-            "status": task.status,
-            "progress": task.progress,
-            "message": task.message,
-            "created_at": task.created_at.isoformat(),
-            "updated_at": task.updated_at.isoformat(),
-            "school_id": task.school_id,
-            "student_info": task_data.get("student", {}),
-            "preferences": task_data.get("preferences", {})
-        }
-        return result
-    finally:
-        db.close()
+    cached = task_cache.get(task_id)
+    if cached is not None:
+        return cached
+    await wait_until_written(task_id)
+    version = task_versions.get(task_id, 0)
+
+    task = (await db.execute(_TASK_BY_ID, {"task_id": task_id})).first()
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    
+    # 解析原始数据
+    task_data = decoder.decode(task.data)
+    
+    result = TaskStatusResponse(
+        task_id=task.id,
+        status=task.status,
+        progress=task.progress,
+        message=task.message,
+        created_at=task.created_at,
+        updated_at=task.updated_at,
+        school_id=task.school_id,
+        student_info=task_data.student,
+        preferences=task_data.preferences
+    )
+    if task_versions.get(task_id, 0) == version:
+        task_cache[task_id] = result
+    return result
 
 
 @app.put("/api/tasks/{task_id}")
-def update_task_status(task_id: int, update: TaskUpdateRequest):
+async def update_task_status(task_id: int, update: TaskUpdateRequest, db: AsyncSession = Depends(get_db)):
     """更新任务状态（供管理员或自动化脚本使用）"""
-    db = SessionLocal()
-    try:
-        task = db.query(Task).filter(Task.id == task_id).first()
-        if not task:
-            raise HTTPException(status_code=404, detail="Task not found")
-        
-        task.status = update.status
-        task.progress = update.progress
-        if update.message:
-            task.message = update.message
-        task.updated_at = datetime.utcnow()
-        
-        db.commit()
-        return {"status": "ok", "message": "任务状态已更新"}
-    finally:
-        db.close()
+    await wait_until_written(task_id)
+    task = await db.get(Task, task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    
+    task.status = update.status
+    task.progress = update.progress
+    if update.message:
+        task.message = update.message
+    task.updated_at = datetime.utcnow()
+    
+    await db.commit()
+    invalidate_task(task_id)
+    return {"status": "ok", "message": "任务状态已更新"}
 
 
 @app.get("/api/enrollments")
-def get_all_enrollments(limit: int = Query(100, le=1000), offset: int = Query(0, ge=0)):
-    """查询所有报名记录（分页）"""
-    db = SessionLocal()
-    try:
-        tasks = db.query(Task).order_by(Task.created_at.desc()).offset(offset).limit(limit).all()
-        total = db.query(Task).count()
-        
-        enrollments = []
-        for task in tasks:
-            task_data = json.loads(task.data)
-            enrollment = {
-                "enrollment_id": task.id,
-                "task_id": task.id,
-                "status": task.status,
-                "progress": task.progress,
-                "message": task.message,
-                "created_at": task.created_at.isoformat(),
-                "updated_at": task.updated_at.isoformat(),
-                **task_data
-            }
-            enrollments.append(enrollment)
-        
-        return {
-            "total": total,
-            "limit": limit,
-            "offset": offset,
-            "enrollments": enrollments
-        }
-    finally:
-        db.close()
+async def get_all_enrollments(
+    limit: int = Query(100, le=1000),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_db)
+):
+    """查询所有报名记录（分页，流式输出）"""
+    total = await db.scalar(select(func.count()).select_from(Task))
+    head = b'{"total":%d,"limit":%d,"offset":%d,"enrollments":[' % (total, limit, offset)
+    return StreamingResponse(
+        stream_enrollments(head, limit, offset),
+        media_type="application/json"
+    )
+
+
+async def stream_enrollments(head: bytes, limit: int, offset: int):
+    """逐批编码报名记录并写出，避免整页数据同时驻留内存"""
+    # 响应开始发送后请求依赖可能已经关闭，这里单独持有会话
+    async with SessionLocal() as db:
+        yield head
+        stmt = (
+            select(*_TASK_COLUMNS)
+            .order_by(Task.created_at.desc())
+            .offset(offset)
+            .limit(limit)
+            .execution_options(yield_per=200)
+        )
+        sep = b""
+        async for tasks in (await db.stream(stmt)).partitions():
+            yield sep + b",".join(
+                json_encoder.encode(to_enrollment_out(task)) for task in tasks
+            )
+            sep = b","
+        yield b"]}"
 
 
 @app.get("/api/enrollments/search")
-def search_enrollments(
+async def search_enrollments(
     email: Optional[str] = Query(None),
     phone: Optional[str] = Query(None),
-    school_id: Optional[str] = Query(None)
+    school_id: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_db)
 ):
     """根据邮箱、电话或学校ID搜索报名记录"""
     if not email and not phone and not school_id:
         raise HTTPException(status_code=400, detail="请提供至少一个搜索条件：email、phone 或 school_id")
     
-    db = SessionLocal()
-    try:
-        query = db.query(Task)
-        
-        if school_id:
-            query = query.filter(Task.school_id == school_id)
-        
-        tasks = query.all()
-        
-        # 在数据中搜索email和phone（因为存储在JSON中）
-        results = []
-        for task in tasks:
-            task_data = json.loads(task.data)
-            student = task_data.get("student", {})
-            
-            match = True
-            if email and student.get("email") != email:
-                match = False
-            if phone and student.get("phone") != phone:
-                match = False
-                
-            if match:
-                result = {
-                    "enrollment_id": task.id,
-                    "task_id": task.id,
-                    "status": task.status,
-                    "progress": task.progress,
-                    "message": task.message,
-                    "created_at": task.created_at.isoformat(),
-                    "updated_at": task.updated_at.isoformat(),
-                    **task_data
-                }
-                results.append(result)
-        
-        return {
-            "total": len(results),
-            "results": results
-        }
-    finally:
-        db.close()
+    query = select(*_TASK_COLUMNS)
+    
+    if school_id:
+        query = query.where(Task.school_id == school_id)
+    if email:
+        query = query.where(Task.email == email)
+    if phone:
+        query = query.where(Task.phone == phone)
+    
+    tasks = (await db.execute(query)).all()
+    
+    results = [to_enrollment_out(task) for task in tasks]
+    
+    return Response(
+        content=json_encoder.encode({"total": len(results), "results": results}),
+        media_type="application/json"
+    )
 
 
 @app.get("/api/stats")
-def get_statistics():
+async def get_statistics(db: AsyncSession = Depends(get_db)):
     """获取系统统计信息"""
-    db = SessionLocal()
-    try:
-        total_tasks = db.query(Task).count()
-        pending_tasks = db.query(Task).filter(Task.status == "pending").count()
-        processing_tasks = db.query(Task).filter(Task.status == "processing").count()
-        completed_tasks = db.query(Task).filter(Task.status == "completed").count()
-        failed_tasks = db.query(Task).filter(Task.status == "failed").count()
-        
-        return {
-            "total_enrollments": total_tasks,
-            "pending": pending_tasks,
-            "processing": processing_tasks,
-            "completed": completed_tasks,
-            "failed": failed_tasks,
-            "last_updated": datetime.utcnow().isoformat()
-        }
-    finally:
-        db.close()
+    # 一次 GROUP BY 取出各状态数量
+    rows = (await db.execute(_STATUS_COUNTS)).all()
+    counts = dict(rows)
+    
+    return {
+        "total_enrollments": sum(counts.values()),
+        "pending": counts.get("pending", 0),
+        "processing": counts.get("processing", 0),
+        "completed": counts.get("completed", 0),
+        "failed": counts.get("failed", 0),
+        "last_updated": datetime.utcnow()
+    }
 
 
 # ------------------ 启动 ------------------
-# 运行命令: uvicorn main:app --reload
\ No newline at end of file
+# 开发: uvicorn main:app --reload
+# 生产: uvicorn main:app --loop uvloop --http httptools --workers 4
+#   每个 worker 有各自的连接池、写入队列和缓存，worker 数按 CPU 核数调整
\ No newline at end of file
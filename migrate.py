@@ -0,0 +1,119 @@
+"""一次性迁移脚本：升级旧版本创建的数据库。
+
+- 把 tasks.data 中旧的 JSON 文本转换为 msgpack，无法解析的行移入 tasks_quarantine
+- 补充 email / phone 索引列并回填
+- 补齐模型中新增的索引（如 tasks.status、configs.school_id），删除已被组合索引覆盖的旧索引
+
+服务启动时会检查上述升级是否完成，未完成则拒绝启动。
+
+运行命令: python migrate.py
+"""
+from datetime import datetime
+from sqlalchemy import text
+import asyncio
+import msgspec
+import orjson
+
+from main import engine, encoder, decoder, Base, EnrollmentData, QuarantinedTask, contact_field
+
+
+def convert_legacy_task_data(conn):
+    """把旧版本以 JSON 文本存储的 Task.data 原地转换为 msgpack，返回（转换行数，隔离行数）"""
+    # 新数据为 BLOB，已转换的行会被跳过
+    rows = conn.execute(
+        text("SELECT id, school_id, data FROM tasks WHERE typeof(data) != 'blob'")
+    ).all()
+    converted = quarantined = 0
+    for task_id, school_id, data in rows:
+        try:
+            # 按读取时的结构校验，保证转换后的数据一定能被 decoder 解析
+            enrollment = msgspec.convert(orjson.loads(data), EnrollmentData)
+        except (TypeError, orjson.JSONDecodeError, msgspec.ValidationError) as e:
+            quarantine_task(conn, task_id, school_id, data, str(e))
+            quarantined += 1
+            continue
+        conn.execute(
+            text("UPDATE tasks SET data = :data WHERE id = :id"),
+            {"id": task_id, "data": encoder.encode(enrollment)},
+        )
+        converted += 1
+    return converted, quarantined
+
+
+def quarantine_task(conn, task_id, school_id, data, reason):
+    """原始数据移入 tasks_quarantine，任务本身标记为失败并换成可解析的占位数据"""
+    QuarantinedTask.__table__.create(conn, checkfirst=True)
+    conn.execute(
+        text(
+            "INSERT OR REPLACE INTO tasks_quarantine (task_id, data, reason, quarantined_at) "
+            "VALUES (:id, :data, :reason, :now)"
+        ),
+        {"id": task_id, "data": data, "reason": reason, "now": datetime.utcnow().isoformat(" ")},
+    )
+    placeholder = EnrollmentData(
+        school_id=school_id or "", student={}, preferences={}, consent_timestamp=""
+    )
+    conn.execute(
+        text(
+            "UPDATE tasks SET data = :data, status = 'failed', "
+            "message = '原始报名数据无法解析，已隔离' WHERE id = :id"
+        ),
+        {"id": task_id, "data": encoder.encode(placeholder)},
+    )
+    print(f"Quarantined task {task_id}: {reason}")
+
+
+def add_contact_columns(conn):
+    """为旧表补充 email / phone 列并从 Task.data 回填，返回回填的行数"""
+    columns = {row[1] for row in conn.execute(text("PRAGMA table_info(tasks)"))}
+    missing = [name for name in ("email", "phone") if name not in columns]
+    if not missing:
+        return 0
+    for name in missing:
+        conn.execute(text(f"ALTER TABLE tasks ADD COLUMN {name} VARCHAR"))
+
+    # 此时所有行都已是 msgpack（隔离的行为占位数据）
+    rows = conn.execute(text("SELECT id, data FROM tasks WHERE typeof(data) = 'blob'")).all()
+    for task_id, data in rows:
+        student = decoder.decode(data).student
+        conn.execute(
+            text("UPDATE tasks SET email = :email, phone = :phone WHERE id = :id"),
+            {
+                "id": task_id,
+                "email": contact_field(student, "email"),
+                "phone": contact_field(student, "phone"),
+            },
+        )
+    return len(rows)
+
+
+def create_missing_indexes(conn):
+    """create_all 不会给已存在的表补索引，这里按模型定义逐个补齐"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def drop_stale_indexes(conn):
+    """删除已被 ix_tasks_school_created 覆盖的单列索引"""
+    conn.execute(text("DROP INDEX IF EXISTS ix_tasks_school_id"))
+
+
+def upgrade(conn):
+    converted, quarantined = convert_legacy_task_data(conn)
+    print(f"已转换 {converted} 条任务数据，隔离 {quarantined} 条无法解析的数据")
+    count = add_contact_columns(conn)
+    print(f"已回填 {count} 条联系方式")
+    create_missing_indexes(conn)
+    drop_stale_indexes(conn)
+
+
+async def main():
+    # engine 是异步引擎，迁移逻辑本身是同步的，通过 run_sync 执行
+    async with engine.begin() as conn:
+        await conn.run_sync(upgrade)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())